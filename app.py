@@ -6,39 +6,238 @@ Flask-based REST API for parsing Russian warehouse invoice PDFs
 
 import os
 import uuid
+import hashlib
+import json
+import time
+import signal
 import tempfile
-from flask import Flask, request, jsonify, send_file
-from flask_cors import CORS
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, CancelledError, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import orjson
+from flask import Flask, Response, request, send_file
 from werkzeug.utils import secure_filename
 from werkzeug.exceptions import RequestEntityTooLarge
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import FileTarget
 import logging
 from datetime import datetime
 
-from pdf_parser import InvoiceParser
+from pdf_parser import parse_pdf_file
+from parse_cache import create_cache
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
-CORS(app)  # Enable CORS for all routes
+
+# CORS headers are the same for every response, so set them statically
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'POST, GET, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type'
+}
+
+@app.before_request
+def handle_preflight():
+    """Answer CORS preflight requests without routing them"""
+    if request.method == 'OPTIONS':
+        return Response(status=204)
+
+@app.after_request
+def add_cors_headers(response):
+    """Enable CORS for all routes"""
+    for name, value in CORS_HEADERS.items():
+        response.headers[name] = value
+    return response
 
 # Configuration
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
-app.config['UPLOAD_FOLDER'] = tempfile.gettempdir()
+app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', tempfile.gettempdir())
 ALLOWED_EXTENSIONS = {'pdf'}
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1MB reads from the request stream
+PARSE_TIMEOUT = 55  # seconds, under gunicorn's and nginx's 60s timeouts
+PARSE_STUCK_GRACE = 5  # seconds past every deadline before a parse counts as stuck
+PDF_MAGIC = b'%PDF-'
+
+# Parsed invoice data keyed by upload content, so repeat uploads skip parsing
+parse_cache = create_cache(app.config['UPLOAD_FOLDER'])
+
+# Process pool for CPU-bound PDF parsing, started per worker by gunicorn's
+# post_fork hook. The development server leaves it unset and parses inline.
+parse_executor = None
+parse_pool_size = 1
+
+def init_parse_executor(max_workers=None):
+    """Start the parsing process pool for this worker"""
+    global parse_executor, parse_pool_size
+    if max_workers is not None:
+        parse_pool_size = max_workers
+    # Fork explicitly so pool processes inherit the preloaded PDF libraries
+    parse_executor = ProcessPoolExecutor(
+        max_workers=parse_pool_size,
+        mp_context=multiprocessing.get_context('fork')
+    )
+    return parse_executor
+
+def stop_executor(executor, terminate=False):
+    """Shut down a pool, optionally killing the parses it is running"""
+    if terminate:
+        # ProcessPoolExecutor has no public API to stop a running task
+        for process in list(executor._processes.values()):
+            process.terminate()
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def shutdown_parse_executor():
+    """Stop the parsing process pool for this worker"""
+    global parse_executor
+    if parse_executor is not None:
+        stop_executor(parse_executor)
+        parse_executor = None
+
+def recycle_parse_executor(executor):
+    """Replace a pool that is stuck or broken, killing its processes"""
+    if parse_executor is executor:
+        logger.warning("Recycling parse pool")
+        # Start the new pool first so requests cancelled by the old one retry on it
+        init_parse_executor()
+        stop_executor(executor, terminate=True)
+
+class ParseDeadlineExceeded(Exception):
+    """Raised inside a pool process when a parse runs past its deadline"""
+
+def _raise_deadline_exceeded(signum, frame):
+    raise ParseDeadlineExceeded()
+
+def parse_with_deadline(file_path, timeout):
+    """Pool entry point: parse with a timeout counted from when the parse starts"""
+    signal.signal(signal.SIGALRM, _raise_deadline_exceeded)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return parse_pdf_file(file_path)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+def watch_parse(executor, future):
+    """Recycle the pool if a parse already handed to it never finishes"""
+    def check():
+        if not future.done():
+            recycle_parse_executor(executor)
+    
+    # Parses ahead of it end within one deadline and it ends within one more,
+    # so a parse still running after that is stuck in C code
+    timer = threading.Timer(2 * PARSE_TIMEOUT + PARSE_STUCK_GRACE, check)
+    timer.daemon = True
+    timer.start()
+
+def submit_and_wait(file_path, timeout):
+    """Run one parse in the pool, applying the timeout"""
+    executor = parse_executor
+    future = executor.submit(parse_with_deadline, file_path, timeout)
+    try:
+        # threading is monkey-patched under gevent, so waiting on the future
+        # yields to the event loop instead of blocking the worker
+        return future.result(timeout=timeout)
+    except ParseDeadlineExceeded as e:
+        raise FutureTimeoutError() from e
+    except FutureTimeoutError:
+        # Still queued behind other parses: drop it and leave the pool alone.
+        # Otherwise its own deadline stops it without touching other parses.
+        if not future.cancel():
+            watch_parse(executor, future)
+        raise
+    except BrokenProcessPool:
+        # A pool process died; later submits would fail until it is replaced
+        recycle_parse_executor(executor)
+        raise
+
+def run_parser(file_path):
+    """Parse a PDF in the process pool, or inline when no pool is running"""
+    if parse_executor is None:
+        return parse_pdf_file(file_path)
+    
+    deadline = time.monotonic() + PARSE_TIMEOUT
+    try:
+        return submit_and_wait(file_path, PARSE_TIMEOUT)
+    except (CancelledError, BrokenProcessPool):
+        # The pool was recycled under this request; retry once on the new one
+        # within what is left of the request's budget
+        remaining = deadline - time.monotonic()
+        if parse_executor is None:
+            raise
+        if remaining <= 0:
+            raise FutureTimeoutError()
+        return submit_and_wait(file_path, remaining)
 
 def allowed_file(filename):
     """Check if uploaded file has allowed extension"""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+class HashingFileTarget(FileTarget):
+    """FileTarget that hashes the upload with SHA256 while it is written to disk
+    
+    Data that does not start with the PDF magic bytes is rejected and never written.
+    """
+    
+    def __init__(self, filename):
+        super().__init__(filename)
+        self.hasher = hashlib.sha256()
+        self.header = b''
+        self.rejected = False
+        self.bytes_written = 0
+    
+    def on_data_received(self, chunk):
+        if self.rejected:
+            return
+        
+        # Check the magic bytes before anything reaches disk
+        if len(self.header) < len(PDF_MAGIC):
+            self.header += chunk[:len(PDF_MAGIC) - len(self.header)]
+            if not PDF_MAGIC.startswith(self.header):
+                self.rejected = True
+                return
+        
+        super().on_data_received(chunk)
+        self.hasher.update(chunk)
+        self.bytes_written += len(chunk)
+    
+    @property
+    def is_pdf(self):
+        """Whether the upload started with the PDF magic bytes"""
+        return not self.rejected and self.header == PDF_MAGIC
+    
+    @property
+    def content_key(self):
+        """Content-addressed key identifying identical uploads"""
+        return self.hasher.hexdigest()
+
+def _json_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def dump_json(obj):
+    """Serialize obj with orjson, falling back to json for integers beyond 64 bits"""
+    try:
+        return orjson.dumps(obj)
+    except orjson.JSONEncodeError:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'),
+                          default=_json_default).encode('utf-8')
+
+def jsonify(obj):
+    """Serialize obj to a JSON response"""
+    return Response(dump_json(obj), mimetype='application/json')
+
 def create_error_response(message, status_code=400):
     """Create standardized error response"""
     return jsonify({
         'status': 'error',
         'message': message,
-        'timestamp': datetime.now().isoformat()
+        'timestamp': datetime.now()
     }), status_code
 
 def create_success_response(data, message="Success"):
@@ -47,17 +246,49 @@ def create_success_response(data, message="Success"):
         'status': 'success',
         'message': message,
         'data': data,
-        'timestamp': datetime.now().isoformat()
+        'timestamp': datetime.now()
+    })
+
+def create_static_response(data, message="Success"):
+    """Serialize a success response that never changes, returning (body, etag)"""
+    body = orjson.dumps({
+        'status': 'success',
+        'message': message,
+        'data': data
     })
+    return body, hashlib.sha256(body).hexdigest()[:16]
+
+def send_static_response(body, etag, cache_control):
+    """Send a precomputed JSON body, answering 304 when the client's ETag matches"""
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response.make_conditional(request)
+
+HEALTH_BODY, HEALTH_ETAG = create_static_response({
+    'service': 'PDF Invoice Parser',
+    'version': '1.0.0',
+    'status': 'healthy'
+})
+
+INFO_BODY, INFO_ETAG = create_static_response({
+    'supported_formats': ['PDF'],
+    'max_file_size_mb': 16,
+    'supported_languages': ['Russian'],
+    'invoice_types': ['Warehouse invoices', 'Storage charges', 'Reception charges'],
+    'extracted_fields': [
+        'invoice_info (number, date)',
+        'company_info (name, INN)',
+        'customer_info (name, INN, address, phone)',
+        'line_items (storage, reception, shipment operations)',
+        'totals (total_amount, vat_amount, total_items)'
+    ]
+})
 
 @app.route('/api/v1/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return create_success_response({
-        'service': 'PDF Invoice Parser',
-        'version': '1.0.0',
-        'status': 'healthy'
-    })
+    return send_static_response(HEALTH_BODY, HEALTH_ETAG, 'no-cache')
 
 @app.route('/api/v1/parse', methods=['POST'])
 def parse_pdf():
@@ -70,40 +301,86 @@ def parse_pdf():
     Returns:
     - JSON with parsed invoice data
     """
+    # Generate unique filename up front so the upload streams straight to disk
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{uuid.uuid4().hex}.pdf")
+    
     try:
-        # Check if file is present
-        if 'file' not in request.files:
+        # Check if request is a multipart upload
+        if request.mimetype != 'multipart/form-data':
             return create_error_response('No file provided')
         
-        file = request.files['file']
+        # Stream the body through the compiled multipart parser,
+        # bypassing werkzeug's form parsing entirely
+        target = HashingFileTarget(file_path)
+        try:
+            form_parser = StreamingFormDataParser(headers=request.headers)
+            form_parser.register('file', target)
+            
+            bytes_received = 0
+            while True:
+                chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                bytes_received += len(chunk)
+                if bytes_received > app.config['MAX_CONTENT_LENGTH']:
+                    raise RequestEntityTooLarge()
+                form_parser.data_received(chunk)
+                
+                # Stop reading as soon as the upload is known not to be a PDF
+                if target.rejected:
+                    return create_error_response('Not a PDF file')
+        except (ValueError, ParseFailedException) as e:
+            logger.warning("Invalid multipart upload: %s", e)
+            return create_error_response('Invalid multipart upload')
+        
+        # Check if file is present
+        if target.multipart_filename is None:
+            return create_error_response('No file provided')
         
         # Check if file is selected
-        if file.filename == '':
+        if target.multipart_filename == '':
             return create_error_response('No file selected')
         
         # Check file extension
-        if not allowed_file(file.filename):
+        if not allowed_file(target.multipart_filename):
             return create_error_response('Invalid file type. Only PDF files are allowed')
         
-        # Generate unique filename
-        filename = secure_filename(file.filename)
-        unique_filename = f"{uuid.uuid4().hex}_{filename}"
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+        # Check file content
+        if not target.is_pdf:
+            return create_error_response('Not a PDF file')
         
-        # Save uploaded file
-        file.save(file_path)
-        logger.info(f"File saved to: {file_path}")
+        filename = secure_filename(target.multipart_filename)
+        content_key = target.content_key
+        logger.info("File saved to: %s (content key %s)", file_path, content_key)
         
         try:
-            # Parse the PDF
-            parser = InvoiceParser(file_path)
-            parsed_data = parser.parse()
+            cached = parse_cache.get(content_key)
+            if cached is not None:
+                logger.info("cache_hit: %s", content_key)
+                parsed_data = orjson.loads(cached)
+            else:
+                logger.info("cache_miss: %s", content_key)
+                
+                # Parse the PDF
+                parsed_data = run_parser(file_path)
+                
+                # parsed_at is stamped per request, so it is not cached
+                parsed_data.pop('parsed_at', None)
+                try:
+                    parse_cache.set(content_key, orjson.dumps(parsed_data))
+                except orjson.JSONEncodeError:
+                    # orjson would read oversized integers back as floats, so
+                    # such results are not cached at all
+                    logger.info("cache_skip: %s has integers beyond 64 bits", content_key)
+            
+            parsed_at = datetime.now()
+            parsed_data['parsed_at'] = parsed_at
             
             # Add parsing metadata
             parsing_info = {
                 'original_filename': filename,
-                'file_size_bytes': os.path.getsize(file_path),
-                'parsed_at': datetime.now().isoformat()
+                'file_size_bytes': target.bytes_written,
+                'parsed_at': parsed_at
             }
             
             response_data = {
@@ -111,44 +388,36 @@ def parse_pdf():
                 'invoice_data': parsed_data
             }
             
-            logger.info(f"Successfully parsed PDF: {filename}")
+            logger.info("Successfully parsed PDF: %s", filename)
             return create_success_response(response_data, "PDF parsed successfully")
             
+        except FutureTimeoutError:
+            logger.error("Timed out parsing PDF %s", filename)
+            return create_error_response(f"PDF parsing timed out after {PARSE_TIMEOUT}s", 504)
+        
         except Exception as parsing_error:
-            logger.error(f"Error parsing PDF {filename}: {str(parsing_error)}")
+            logger.error("Error parsing PDF %s: %s", filename, parsing_error)
             return create_error_response(f"Error parsing PDF: {str(parsing_error)}", 500)
-        
-        finally:
-            # Clean up temporary file
-            try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                    logger.info(f"Temporary file deleted: {file_path}")
-            except OSError as e:
-                logger.warning(f"Could not delete temporary file {file_path}: {e}")
     
     except RequestEntityTooLarge:
         return create_error_response('File too large. Maximum size is 16MB', 413)
     except Exception as e:
-        logger.error(f"Unexpected error in parse_pdf: {str(e)}")
+        logger.error("Unexpected error in parse_pdf: %s", e)
         return create_error_response(f"Internal server error: {str(e)}", 500)
+    
+    finally:
+        # Clean up temporary file
+        try:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+                logger.info("Temporary file deleted: %s", file_path)
+        except OSError as e:
+            logger.warning("Could not delete temporary file %s: %s", file_path, e)
 
 @app.route('/api/v1/parse/info', methods=['GET'])
 def parse_info():
     """Get information about the parsing service"""
-    return create_success_response({
-        'supported_formats': ['PDF'],
-        'max_file_size_mb': 16,
-        'supported_languages': ['Russian'],
-        'invoice_types': ['Warehouse invoices', 'Storage charges', 'Reception charges'],
-        'extracted_fields': [
-            'invoice_info (number, date)',
-            'company_info (name, INN)',
-            'customer_info (name, INN, address, phone)',
-            'line_items (storage, reception, shipment operations)',
-            'totals (total_amount, vat_amount, total_items)'
-        ]
-    })
+    return send_static_response(INFO_BODY, INFO_ETAG, 'public, max-age=300')
 
 @app.errorhandler(404)
 def not_found(error):
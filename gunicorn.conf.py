@@ -9,14 +9,18 @@ bind = "127.0.0.1:5000"
 backlog = 2048
 
 # Worker processes
-workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = "sync"
-worker_connections = 1000
-timeout = 30
-keepalive = 2
+# gevent workers multiplex connections and hand parsing to their own process
+# pool, so one worker per core is enough
+workers = multiprocessing.cpu_count()
+worker_class = "gevent"
+worker_connections = 2000
+timeout = 60  # large multi-page invoices can take this long to parse
+graceful_timeout = 30  # let in-flight parses finish on reload/shutdown
+keepalive = 30  # reuse nginx -> gunicorn connections
 
 # Restart workers after this many requests, to prevent memory leaks
-max_requests = 1000
+# (pdfminer's per-parse allocations grow the worker over time)
+max_requests = 200
 max_requests_jitter = 50
 
 # Logging
@@ -42,6 +46,11 @@ limit_request_field_size = 8190
 
 # Performance
 preload_app = True
+
+# Keep uploads on RAM-backed tmpfs. raw_env is applied before preload_app
+# imports the app, so app.py picks the folder up at import time.
+UPLOAD_FOLDER = "/dev/shm/pdf-parser-uploads"
+raw_env = [f"UPLOAD_FOLDER={UPLOAD_FOLDER}"]
 enable_stdio_inheritance = True
 
 # SSL (uncomment and configure if using HTTPS)
@@ -52,6 +61,9 @@ enable_stdio_inheritance = True
 def on_starting(server):
     """Called just before the master process is initialized."""
     server.log.info("PDF Invoice Parser starting...")
+    # /dev/shm is shared by all local users, so keep uploads private
+    os.makedirs(UPLOAD_FOLDER, mode=0o700, exist_ok=True)
+    os.chmod(UPLOAD_FOLDER, 0o700)
 
 def on_reload(server):
     """Called to recycle workers during a reload via SIGHUP."""
@@ -61,6 +73,18 @@ def when_ready(server):
     """Called just after the server is started."""
     server.log.info("PDF Invoice Parser ready to serve requests")
 
+def post_fork(server, worker):
+    """Called just after a worker has been forked."""
+    from app import init_parse_executor
+    # Split the cores across workers so all pools together use about one
+    # parse process per core (one per worker with the default worker count)
+    init_parse_executor(max(1, multiprocessing.cpu_count() // server.cfg.workers))
+
+def worker_exit(server, worker):
+    """Called just after a worker has been exited, in the worker process."""
+    from app import shutdown_parse_executor
+    shutdown_parse_executor()
+
 def on_exit(server):
     """Called just before exiting."""
     server.log.info("PDF Invoice Parser shutting down...")
\ No newline at end of file
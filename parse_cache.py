@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Parse result cache for PDF Invoice Parser Web Service
+Stores parsed invoice JSON keyed by the SHA256 content key of the upload
+"""
+
+import os
+import re
+import time
+import tempfile
+import logging
+
+from pdf_parser import PARSER_VERSION
+
+try:
+    import redis
+except ImportError:  # Redis is optional, the filesystem cache is used instead
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+CACHE_TTL_SECONDS = 24 * 60 * 60  # 1 day
+REDIS_KEY_PREFIX = f'pdf-parser:parse:v{PARSER_VERSION}:'
+FILE_CACHE_MAX_ENTRIES = 1000
+FILE_CACHE_SWEEP_INTERVAL = 60  # seconds between eviction sweeps
+FILE_CACHE_DIR_NAME = 'pdf-parser-cache'
+FILE_CACHE_TMP_PREFIX = 'pdf-parser-'
+
+# Files the cache itself creates; the sweep never touches anything else
+_RE_CACHE_FILE = re.compile(r'v\d+-[0-9a-f]+\.json|' + re.escape(FILE_CACHE_TMP_PREFIX) + r'.*\.tmp')
+
+class RedisCache:
+    """Parse result cache backed by Redis"""
+
+    def __init__(self, client, ttl=CACHE_TTL_SECONDS):
+        self.client = client
+        self.ttl = ttl
+
+    def get(self, key):
+        """Return cached JSON for key, or None on miss"""
+        try:
+            return self.client.get(REDIS_KEY_PREFIX + key)
+        except redis.exceptions.RedisError as e:
+            logger.warning("Redis cache read failed for %s: %s", key, e)
+            return None
+
+    def set(self, key, value):
+        """Store JSON for key with the cache TTL"""
+        try:
+            self.client.setex(REDIS_KEY_PREFIX + key, self.ttl, value)
+        except redis.exceptions.RedisError as e:
+            logger.warning("Redis cache write failed for %s: %s", key, e)
+
+class FileCache:
+    """Parse result cache stored as one JSON file per key
+    
+    Expired entries and the oldest entries beyond max_entries are evicted
+    by a periodic sweep on write.
+    """
+
+    def __init__(self, cache_dir, ttl=CACHE_TTL_SECONDS, max_entries=FILE_CACHE_MAX_ENTRIES):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.last_sweep = 0
+        # Cached results hold customer data, so keep the directory private
+        try:
+            os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+            os.chmod(cache_dir, 0o700)
+        except OSError as e:
+            logger.warning("Could not set up file cache at %s: %s", cache_dir, e)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"v{PARSER_VERSION}-{key}.json")
+
+    def get(self, key):
+        """Return cached JSON for key, or None on miss or expiry"""
+        try:
+            with open(self._path(key), 'rb') as f:
+                if time.time() - os.fstat(f.fileno()).st_mtime > self.ttl:
+                    return None
+                return f.read()
+        except OSError:
+            return None
+
+    def set(self, key, value):
+        """Store JSON for key"""
+        # Write to a temp file and rename so readers never see a partial entry
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                dir=self.cache_dir, prefix=FILE_CACHE_TMP_PREFIX, suffix='.tmp'
+            )
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            logger.warning("File cache write failed for %s: %s", key, e)
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+        if time.time() - self.last_sweep > FILE_CACHE_SWEEP_INTERVAL:
+            self.sweep()
+
+    def sweep(self):
+        """Delete expired entries, then the oldest ones beyond max_entries"""
+        now = time.time()
+        self.last_sweep = now
+        entries = []
+        try:
+            with os.scandir(self.cache_dir) as it:
+                for entry in it:
+                    if not _RE_CACHE_FILE.fullmatch(entry.name):
+                        continue
+                    try:
+                        mtime = entry.stat().st_mtime
+                    except OSError:
+                        continue
+                    entries.append((mtime, entry.path))
+        except OSError as e:
+            logger.warning("File cache sweep failed: %s", e)
+            return
+
+        # Entries from older parser versions are never read again and age out here too
+        entries.sort()
+        excess = len(entries) - self.max_entries
+        for i, (mtime, path) in enumerate(entries):
+            if i >= excess and now - mtime <= self.ttl:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def create_cache(upload_folder):
+    """Create the parse result cache, preferring Redis when it is reachable"""
+    if redis is not None:
+        redis_url = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+        client = redis.Redis.from_url(redis_url, decode_responses=True, socket_connect_timeout=1)
+        try:
+            client.ping()
+            logger.info("Using Redis parse cache at %s", redis_url)
+            return RedisCache(client)
+        except redis.exceptions.RedisError as e:
+            logger.warning("Redis unavailable (%s), falling back to file cache", e)
+
+    cache_dir = os.path.join(upload_folder, FILE_CACHE_DIR_NAME)
+    logger.info("Using file parse cache at %s", cache_dir)
+    return FileCache(cache_dir)
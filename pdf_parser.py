@@ -6,8 +6,54 @@ Parses invoice-act.pdf and extracts structured data
 
 import re
 import json
+import logging
+import orjson
 from datetime import datetime
 import pdfplumber
+import pypdfium2 as pdfium
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the structure or content of parsed data changes, so cached
+# results from older parser versions are not served
+PARSER_VERSION = 4
+
+# Precompiled patterns used by the line parsers
+_RE_INVOICE = re.compile(r'№\s*([\d-]+)\s*от\s*([\d.]+)')
+_RE_COMPANY = re.compile(r'Исполнитель:\s*(.+?)\s*,\s*ИНН\s*(\d+)')
+_RE_CUSTOMER = re.compile(r'Заказчик:\s*(.+?)\s*,\s*ИНН\s*(\d+)')
+_RE_ADDRESS = re.compile(r'Адрес:\s*([^,]+(?:,[^,]+)*)\s*,\s*тел\.\s*([\+\d\s\(\)-]+)')
+_RE_STORAGE = re.compile(
+    r'Хранение товаров от\s*([\d.]+)\s*до\s*([\d.]+)\s*([\d.,]+)\s*м³\s*([\d.,]+)\s*₽\s*([\d.,]+)\s*₽'
+)
+_RE_RECEPTION = re.compile(
+    r'Приемка товара на склад и размещение\s*(\d+)\s*шт\.\s*([\d.,]+)\s*₽\s*([\d.,]+)\s*₽'
+)
+_RE_SHIPMENT = re.compile(r'Отгрузка FBO\s*(\d+)\s*от\s*([\d.]+)')
+_RE_RECEPTION_OP = re.compile(r'Приемка\s+(\d+)\s+от\s+([\d.]+)')
+_RE_TOTAL = re.compile(r'Итого к оплате:\s*([\d.,]+)\s*₽')
+_RE_VAT = re.compile(r'В том числе НДС:\s*([\d.,]+)\s*₽')
+_RE_ITEMS = re.compile(r'Всего наименований\s*(\d+)\s*на сумму\s*([\d.,]+)\s*₽')
+_RE_NUM_EXTRACT = re.compile(r'[-+]?(?:\d[\d.]*|\.\d+)')
+_LINE_ITER = re.compile(r'[^\n]+')
+
+def _parse_number(value):
+    """Parse a number from string, handling Russian number format"""
+    if not value:
+        return 0.0
+    
+    # Drop all whitespace (including thousands separators) and the currency
+    # symbol, and turn the decimal comma into a dot
+    str_value = ''.join(str(value).split()).replace('₽', '').replace(',', '.')
+    
+    number_match = _RE_NUM_EXTRACT.search(str_value)
+    if number_match:
+        try:
+            return float(number_match.group())
+        except ValueError:
+            return 0.0
+    
+    return 0.0
 
 class InvoiceParser:
     def __init__(self, pdf_path):
@@ -23,82 +69,71 @@ class InvoiceParser:
     
     def parse(self):
         """Parse the PDF and extract all data"""
-        print(f"Parsing PDF: {self.pdf_path}")
+        logger.debug("Parsing PDF: %s", self.pdf_path)
         
-        with pdfplumber.open(self.pdf_path) as pdf:
-            full_text = ""
-            
-            # Extract text from all pages
-            for page_num, page in enumerate(pdf.pages, 1):
-                print(f"Processing page {page_num}")
-                page_text = page.extract_text()
-                if page_text:
-                    full_text += page_text + "\n"
-                
-                # Try to extract tables
-                tables = page.extract_tables()
-                if tables:
-                    print(f"Found {len(tables)} tables on page {page_num}")
-                    self._parse_tables(tables)
-        
-        # Parse header information
-        self._parse_header_info(full_text)
+        # Extract text from all pages
+        full_text = self._extract_text()
         
-        # Parse line items from text
-        self._parse_line_items(full_text)
+        # Parse header, line items and totals in a single pass
+        self._parse_all(full_text)
         
-        # Parse totals
-        self._parse_totals(full_text)
+        # Table extraction is only needed when the text pass missed some rows
+        if not self._text_items_complete():
+            text_items = self.data['line_items']
+            self.data['line_items'] = []
+            
+            with pdfplumber.open(self.pdf_path) as pdf:
+                for page_num, page in enumerate(pdf.pages, 1):
+                    tables = page.extract_tables()
+                    if tables:
+                        logger.debug("Found %d tables on page %d", len(tables), page_num)
+                        self._parse_tables(tables)
+            
+            # Table rows come first, as when every page's tables were merged
+            self.data['line_items'].extend(text_items)
         
         return self.data
     
-    def _parse_header_info(self, text):
-        """Extract invoice header information"""
-        lines = text.split('\n')
+    def _text_items_complete(self):
+        """Check whether the text line items add up to the invoice total"""
+        line_items = self.data['line_items']
+        invoice_sum = self.data['totals'].get('total_sum', self.data['totals'].get('total_amount'))
+        if not line_items or invoice_sum is None:
+            return False
         
-        for line in lines:
-            line = line.strip()
-            
-            # Invoice number and date
-            if 'Детализация к счету №' in line:
-                invoice_match = re.search(r'№\s*([\d-]+)\s*от\s*([\d.]+)', line)
-                if invoice_match:
-                    self.data['invoice_info']['number'] = invoice_match.group(1)
-                    self.data['invoice_info']['date'] = invoice_match.group(2)
-            
-            # Company info (Исполнитель)
-            if 'Исполнитель:' in line:
-                company_match = re.search(r'Исполнитель:\s*(.+?)\s*,\s*ИНН\s*(\d+)', line)
-                if company_match:
-                    self.data['company_info']['name'] = company_match.group(1).strip()
-                    self.data['company_info']['inn'] = company_match.group(2)
-            
-            # Customer info (Заказчик)
-            if 'Заказчик:' in line:
-                customer_match = re.search(r'Заказчик:\s*(.+?)\s*,\s*ИНН\s*(\d+)', line)
-                if customer_match:
-                    self.data['customer_info']['name'] = customer_match.group(1).strip()
-                    self.data['customer_info']['inn'] = customer_match.group(2)
-                
-                # Extract address and phone if present
-                address_match = re.search(r'Адрес:\s*([^,]+(?:,[^,]+)*)\s*,\s*тел\.\s*([\+\d\s\(\)-]+)', line)
-                if address_match:
-                    self.data['customer_info']['address'] = address_match.group(1).strip()
-                    self.data['customer_info']['phone'] = address_match.group(2).strip()
+        items_sum = sum(item['total_amount'] for item in line_items)
+        return abs(items_sum - invoice_sum) < 0.01
     
-    def _parse_line_items(self, text):
-        """Extract line items with amounts"""
-        lines = text.split('\n')
+    def _extract_text(self):
+        """Extract raw text from all pages using PDFium"""
+        full_text = ""
+        
+        pdf = pdfium.PdfDocument(self.pdf_path)
+        try:
+            for page_num, page in enumerate(pdf, 1):
+                logger.debug("Processing page %d", page_num)
+                textpage = page.get_textpage()
+                page_text = textpage.get_text_range()
+                textpage.close()
+                page.close()
+                if page_text:
+                    full_text += page_text + "\n"
+        finally:
+            pdf.close()
         
-        for i, line in enumerate(lines):
-            line = line.strip()
+        return full_text
+    
+    def _parse_all(self, text):
+        """Extract header information, line items and totals from text
+        
+        Markers are checked in order of frequency: line items, totals, header.
+        """
+        for line_match in _LINE_ITER.finditer(text):
+            line = line_match.group().strip()
             
             # Look for storage charges (Хранение товаров)
             if 'Хранение товаров от' in line:
-                storage_match = re.search(
-                    r'Хранение товаров от\s*([\d.]+)\s*до\s*([\d.]+)\s*([\d.,]+)\s*м³\s*([\d.,]+)\s*₽\s*([\d.,]+)\s*₽',
-                    line
-                )
+                storage_match = _RE_STORAGE.search(line)
                 if storage_match:
                     item = {
                         'type': 'storage',
@@ -114,10 +149,7 @@ class InvoiceParser:
             
             # Look for reception charges (Приемка товара)
             elif 'Приемка товара на склад' in line:
-                reception_match = re.search(
-                    r'Приемка товара на склад и размещение\s*(\d+)\s*шт\.\s*([\d.,]+)\s*₽\s*([\d.,]+)\s*₽',
-                    line
-                )
+                reception_match = _RE_RECEPTION.search(line)
                 if reception_match:
                     item = {
                         'type': 'reception',
@@ -131,7 +163,7 @@ class InvoiceParser:
             
             # Look for shipment operations (Отгрузка FBO)
             elif 'Отгрузка FBO' in line:
-                shipment_match = re.search(r'Отгрузка FBO\s*(\d+)\s*от\s*([\d.]+)', line)
+                shipment_match = _RE_SHIPMENT.search(line)
                 if shipment_match:
                     item = {
                         'type': 'shipment',
@@ -143,48 +175,70 @@ class InvoiceParser:
                     self.data['line_items'].append(item)
             
             # Look for reception operations (Приемка with number)
-            elif re.match(r'Приемка\s+\d+\s+от', line):
-                reception_match = re.search(r'Приемка\s+(\d+)\s+от\s+([\d.]+)', line)
-                if reception_match:
-                    item = {
-                        'type': 'reception_operation',
-                        'description': f"Приемка {reception_match.group(1)}",
-                        'reception_number': reception_match.group(1),
-                        'date': reception_match.group(2),
-                        'total_amount': 0  # Usually no charge unless specified
-                    }
-                    self.data['line_items'].append(item)
-    
-    def _parse_totals(self, text):
-        """Extract total amounts"""
-        lines = text.split('\n')
-        
-        for line in lines:
-            line = line.strip()
+            elif (reception_match := _RE_RECEPTION_OP.match(line)):
+                item = {
+                    'type': 'reception_operation',
+                    'description': f"Приемка {reception_match.group(1)}",
+                    'reception_number': reception_match.group(1),
+                    'date': reception_match.group(2),
+                    'total_amount': 0  # Usually no charge unless specified
+                }
+                self.data['line_items'].append(item)
             
             # Total amount (Итого к оплате)
-            if 'Итого к оплате:' in line:
-                total_match = re.search(r'Итого к оплате:\s*([\d.,]+)\s*₽', line)
+            elif 'Итого к оплате:' in line:
+                total_match = _RE_TOTAL.search(line)
                 if total_match:
                     self.data['totals']['total_amount'] = float(total_match.group(1).replace(',', '.'))
             
             # VAT amount (НДС)
             elif 'В том числе НДС:' in line:
-                vat_match = re.search(r'В том числе НДС:\s*([\d.,]+)\s*₽', line)
+                vat_match = _RE_VAT.search(line)
                 if vat_match:
                     self.data['totals']['vat_amount'] = float(vat_match.group(1).replace(',', '.'))
             
             # Total items
             elif 'Всего наименований' in line:
-                items_match = re.search(r'Всего наименований\s*(\d+)\s*на сумму\s*([\d.,]+)\s*₽', line)
+                items_match = _RE_ITEMS.search(line)
                 if items_match:
                     self.data['totals']['total_items'] = int(items_match.group(1))
                     self.data['totals']['total_sum'] = float(items_match.group(2).replace(',', '.'))
+            
+            # Invoice number and date
+            elif 'Детализация к счету №' in line:
+                invoice_match = _RE_INVOICE.search(line)
+                if invoice_match:
+                    self.data['invoice_info']['number'] = invoice_match.group(1)
+                    self.data['invoice_info']['date'] = invoice_match.group(2)
+            
+            else:
+                # Company info (Исполнитель)
+                if 'Исполнитель:' in line:
+                    company_match = _RE_COMPANY.search(line)
+                    if company_match:
+                        self.data['company_info']['name'] = company_match.group(1).strip()
+                        self.data['company_info']['inn'] = company_match.group(2)
+                
+                # Customer info (Заказчик)
+                if 'Заказчик:' in line:
+                    customer_match = _RE_CUSTOMER.search(line)
+                    if customer_match:
+                        self.data['customer_info']['name'] = customer_match.group(1).strip()
+                        self.data['customer_info']['inn'] = customer_match.group(2)
+                    
+                    # Extract address and phone if present
+                    address_match = _RE_ADDRESS.search(line)
+                    if address_match:
+                        self.data['customer_info']['address'] = address_match.group(1).strip()
+                        self.data['customer_info']['phone'] = address_match.group(2).strip()
     
     def _parse_tables(self, tables):
         """Parse table data if available"""
+        # Rows repeating a description or unit share one string object
+        strings = {}
+        
         for table_num, table in enumerate(tables):
-            print(f"Table {table_num + 1} has {len(table)} rows")
+            logger.debug("Table %d has %d rows", table_num + 1, len(table))
             
             # Look for the main services table
             for row_num, row in enumerate(table):
@@ -196,13 +250,15 @@ class InvoiceParser:
                     # Try to extract structured data from table rows
                     if row[0] and str(row[0]).isdigit():  # Row number
                         try:
+                            description = str(row[1] or '').strip()
+                            unit = str(row[3] or '').strip()
                             item = {
                                 'row_number': int(row[0]),
-                                'description': str(row[1] or '').strip(),
-                                'quantity': self._parse_number(row[2]) if len(row) > 2 else 0,
-                                'unit': str(row[3] or '').strip() if len(row) > 3 else '',
-                                'price_per_unit': self._parse_number(row[4]) if len(row) > 4 else 0,
-                                'total_amount': self._parse_number(row[5]) if len(row) > 5 else 0
+                                'description': strings.setdefault(description, description),
+                                'quantity': _parse_number(row[2]),
+                                'unit': strings.setdefault(unit, unit),
+                                'price_per_unit': _parse_number(row[4]),
+                                'total_amount': _parse_number(row[5]) if len(row) > 5 else 0.0
                             }
                             
                             # Only add if it has meaningful data
@@ -214,34 +270,15 @@ class InvoiceParser:
                         except (ValueError, IndexError):
                             continue
     
-    def _parse_number(self, value):
-        """Parse a number from string, handling Russian number format"""
-        if not value:
-            return 0
-        
-        # Convert to string and clean
-        str_value = str(value).strip()
-        
-        # Remove currency symbols
-        str_value = re.sub(r'[₽\s]', '', str_value)
-        
-        # Replace comma with dot for decimal separator
-        str_value = str_value.replace(',', '.')
-        
-        # Extract number
-        number_match = re.search(r'[\d.]+', str_value)
-        if number_match:
-            try:
-                return float(number_match.group())
-            except ValueError:
-                return 0
-        
-        return 0
-    
     def save_to_json(self, output_path):
         """Save parsed data to JSON file"""
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        try:
+            body = orjson.dumps(self.data, option=orjson.OPT_INDENT_2)
+        except orjson.JSONEncodeError:
+            # orjson rejects integers beyond 64 bits, json does not
+            body = json.dumps(self.data, ensure_ascii=False, indent=2, default=str).encode('utf-8')
+        with open(output_path, 'wb') as f:
+            f.write(body)
         print(f"Data saved to: {output_path}")
     
     def print_summary(self):
@@ -277,6 +314,10 @@ class InvoiceParser:
             print(f"VAT Amount: {self.data['totals'].get('vat_amount', 0):.2f} ₽")
             print(f"Total Items: {self.data['totals'].get('total_items', 0)}")
 
+def parse_pdf_file(pdf_path):
+    """Parse a PDF file and return its data (picklable entry point for process pools)"""
+    return InvoiceParser(pdf_path).parse()
+
 def main():
     """Main function to test PDF parsing"""
     pdf_path = "invoice-act.pdf"
@@ -4,9 +4,14 @@ WSGI entry point for PDF Invoice Parser Web Service
 Production deployment configuration
 """
 
+# Patch the stdlib for gevent workers before anything imports socket/ssl
+from gevent import monkey
+monkey.patch_all()
+
 import os
 import sys
 import logging
+import tempfile
 from logging.handlers import RotatingFileHandler
 
 # Add the current directory to Python path
@@ -24,6 +29,25 @@ class ProductionConfig:
     LOG_FILE = '/var/log/pdf-parser/app.log'
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB
     
+# Minimal one-page PDF used to warm up the parsing stack
+WARMUP_PDF = (
+    b'%PDF-1.4\n'
+    b'1 0 obj\n<< /Type /Catalog /Pages 2 0 R >>\nendobj\n'
+    b'2 0 obj\n<< /Type /Pages /Kids [3 0 R] /Count 1 >>\nendobj\n'
+    b'3 0 obj\n<< /Type /Page /Parent 2 0 R /MediaBox [0 0 200 50] /Contents 4 0 R '
+    b'/Resources << /Font << /F1 5 0 R >> >> >>\nendobj\n'
+    b'4 0 obj\n<< /Length 37 >>\nstream\nBT /F1 12 Tf 10 20 Td (warm-up) Tj ET\nendstream\nendobj\n'
+    b'5 0 obj\n<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>\nendobj\n'
+    b'xref\n0 6\n'
+    b'0000000000 65535 f \n'
+    b'0000000009 00000 n \n'
+    b'0000000058 00000 n \n'
+    b'0000000115 00000 n \n'
+    b'0000000240 00000 n \n'
+    b'0000000327 00000 n \n'
+    b'trailer\n<< /Size 6 /Root 1 0 R >>\nstartxref\n397\n%%EOF\n'
+)
+
 def setup_logging():
     """Setup production logging"""
     # Create log directory if it doesn't exist
@@ -53,6 +77,28 @@ def setup_logging():
     root_logger.addHandler(file_handler)
     root_logger.setLevel(ProductionConfig.LOG_LEVEL)
 
+def warm_up_parser():
+    """Import and exercise the PDF libraries before gunicorn forks workers
+    
+    With preload_app the loaded modules and pdfminer's font/CMap caches are
+    then shared copy-on-write by every worker and parsing process.
+    """
+    # Imported only so the modules are loaded before fork
+    import pdfplumber  # noqa: F401
+    import pdfminer.high_level  # noqa: F401
+    from pdfminer.layout import LAParams  # noqa: F401
+    import PIL.Image  # noqa: F401
+    import pypdfium2  # noqa: F401
+    from pdf_parser import parse_pdf_file
+    
+    try:
+        with tempfile.NamedTemporaryFile(suffix='.pdf') as warmup_file:
+            warmup_file.write(WARMUP_PDF)
+            warmup_file.flush()
+            parse_pdf_file(warmup_file.name)
+    except Exception as e:
+        app.logger.warning(f"Parser warm-up failed: {e}")
+
 def create_application():
     """Create and configure the application for production"""
     
@@ -62,6 +108,9 @@ def create_application():
     # Setup logging
     setup_logging()
     
+    # Load the PDF stack once in the master process
+    warm_up_parser()
+    
     # Log startup
     app.logger.info("PDF Invoice Parser Web Service starting in production mode")
     app.logger.info(f"Log file: {ProductionConfig.LOG_FILE}")